@@ -24,6 +24,9 @@ from .mcts_cpp import (PyMcts, PyPS_MAX, PyPS_SAMPLE_AC,
 
 # pylint: enable=no-name-in-module
 
+# `inference_mode` is only available for torch>=1.9. It is cheaper than `no_grad` since it also skips view and version tracking.
+_inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
 
 class Mcts(PyMcts):
 
@@ -46,6 +49,8 @@ class Mcts(PyMcts):
 
     def __init__(self, *args, agent: BasePG = None, **kwargs):
         self.agent = agent
+        # Pinned host buffers for device-to-host copies of evaluation outputs, keyed by name.
+        self._host_buffers: Dict[str, torch.Tensor] = dict()
         if g.play_strategy == 'max':
             self.play_strategy = PyPS_MAX
         else:
@@ -62,14 +67,22 @@ class Mcts(PyMcts):
         values = [None] * len(states)
         outstanding_idx = list()
         outstanding_states = list()
+        # Duplicate states (due to exploration collapse) are only evaluated once. `to_unique` maps the index of every state that needs evaluation to its position in `outstanding_states`.
+        to_unique = dict()
+        key2pos = dict()
+        np_steps = steps.cpu().numpy() if (steps is not None and not isinstance(steps, int)) else None
         # Deal with end states first.
         for i, state in enumerate(states):
             if state.stopped or state.done:
                 # NOTE(j_luo) This value is used for backup. If already reaching the end state, the final reward is either accounted for by the step reward, or by the value network. Therefore, we need to set it to 0.0 here.
                 values[i] = 0.0
             else:
-                outstanding_idx.append(i)
-                outstanding_states.append(state)
+                key = (state.node_id, None if np_steps is None else np_steps[i])
+                if key not in key2pos:
+                    key2pos[key] = len(outstanding_states)
+                    outstanding_idx.append(i)
+                    outstanding_states.append(state)
+                to_unique[i] = key2pos[key]
 
         # Collect states that need evaluation.
         if outstanding_states:
@@ -90,17 +103,25 @@ class Mcts(PyMcts):
             # NOTE(j_luo) Don't forget to call exp().
             priors = self.agent.get_policy(id_seqs, almts=(almts1, almts2)).exp()
             with NoName(priors):
-                meta_priors = priors[:, [0, 2, 3, 4, 5, 6]].cpu().numpy()
-                special_priors = priors[:, 1].cpu().numpy()
+                host_priors = self._copy_to_host('priors', priors)
+            if g.use_value_guidance:
+                host_values = self._copy_to_host('values', self.agent.get_values(id_seqs, steps=steps).rename(None))
+            # Wait for all copies at once. Everything below is done on the host.
+            if priors.is_cuda:
+                torch.cuda.current_stream(priors.device).synchronize()
+            host_priors = host_priors.numpy()
+            meta_priors = host_priors[:, [0, 2, 3, 4, 5, 6]]
+            special_priors = host_priors[:, 1]
             if g.use_value_guidance:
-                agent_values = self.agent.get_values(id_seqs, steps=steps).cpu().numpy()
+                agent_values = host_values.numpy()
             else:
                 agent_values = np.zeros([len(id_seqs)], dtype='float32')
 
-            for i, state, mp, sp, v in zip(outstanding_idx, outstanding_states, meta_priors, special_priors, agent_values):
-                # NOTE(j_luo) Values should be returned even if states are duplicates or have been visited.
-                values[i] = v
-                # NOTE(j_luo) Skip duplicate states (due to exploration collapse) or visited states (due to rollout truncation).
+            # NOTE(j_luo) Values should be returned even if states are duplicates or have been visited.
+            for i, pos in to_unique.items():
+                values[i] = agent_values[pos]
+            for state, mp, sp in zip(outstanding_states, meta_priors, special_priors):
+                # NOTE(j_luo) Skip visited states (due to rollout truncation).
                 if not state.is_leaf():
                     continue
 
@@ -108,6 +129,20 @@ class Mcts(PyMcts):
                 self.env.evaluate(state, mp, sp)
         return values
 
+    def _copy_to_host(self, name: str, tensor: torch.Tensor) -> torch.Tensor:
+        """Start a non-blocking copy of an unnamed `tensor` into the pinned host buffer `name`. The result is only
+        valid after the current stream is synchronized, and is overwritten by the next copy with the same `name`."""
+        if not tensor.is_cuda:
+            return tensor.rename(None)
+        numel = tensor.numel()
+        buf = self._host_buffers.get(name)
+        if buf is None or buf.numel() < numel or buf.dtype != tensor.dtype:
+            buf = torch.empty(numel, dtype=tensor.dtype, pin_memory=True)
+            self._host_buffers[name] = buf
+        host = buf[:numel].view(tensor.shape)
+        host.copy_(tensor, non_blocking=True)
+        return host
+
     def add_noise(self, state: VocabState):
         """Add Dirichlet noise to `state`, usually the root."""
         noise = np.random.dirichlet(g.dirichlet_alpha * np.ones(7 * len(self.env.abc))).astype('float32')
@@ -130,7 +165,8 @@ class Mcts(PyMcts):
         num_episodes = num_episodes or g.num_episodes
         # if no_simulation:
         #     breakpoint()  # BREAKPOINT(j_luo)
-        with self.agent.policy_grad(False), self.agent.value_grad(False):
+        # Nothing computed here requires grad -- only numpy arrays and trajectories leave this block.
+        with _inference_mode(), self.agent.policy_grad(False), self.agent.value_grad(False):
             for ei in range(num_episodes):
                 root = init_state
                 self.reset()
@@ -78,6 +78,11 @@ cdef class PyTreeNode:
     def is_leaf(self) -> bool:
         return self.ptr.is_leaf()
 
+    @property
+    def node_id(self) -> int:
+        """Address of the underlying node. Different wrappers around the same node share the same id."""
+        return <size_t>self.ptr
+
     @property
     def action_counts(self):
         return np.asarray((<BaseNode *>self.ptr).get_action_counts(), dtype='long')
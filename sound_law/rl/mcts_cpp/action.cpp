@@ -390,29 +390,48 @@ void ActionSpace::expand_special_type(MiniNode *node, BaseNode *parent, int chos
     }
     else
     {
+        // The aligned units do not depend on `after_id`, so they are looked up once for all candidates.
+        auto aligned_units = get_aligned_units(node->base, aff);
         // Must use `unit2base` since stress is included for before.
         if (st == SpecialType::GBJ)
-            update_affected_with_after_id(node, aff, gbj_map.at(before));
+            update_affected_with_after_id(node, aff, aligned_units, gbj_map.at(before));
         else if (st == SpecialType::GBW)
-            update_affected_with_after_id(node, aff, gbw_map.at(before));
+            update_affected_with_after_id(node, aff, aligned_units, gbw_map.at(before));
         else if (force_apply)
             // HACK(j_luo) this is hacky.
             for (abc_t after_id = 0; after_id < opt.num_abc; ++after_id)
-                update_affected_with_after_id(node, aff, after_id);
+                update_affected_with_after_id(node, aff, aligned_units, after_id);
         else
             for (abc_t after_id : permissible_changes.at(before))
-                update_affected_with_after_id(node, aff, after_id);
+                update_affected_with_after_id(node, aff, aligned_units, after_id);
     }
 }
 
-void ActionSpace::update_affected_with_after_id(MiniNode *node, const Affected &affected, abc_t after_id) const
+vec<pair<abc_t, abc_t>> ActionSpace::get_aligned_units(const TreeNode *base, const Affected &affected) const
 {
+    auto ret = vec<pair<abc_t, abc_t>>();
+    if (!word_space->opt.use_alignment)
+        return ret;
+
+    ret.reserve(affected.size());
+    for (size_t index = 0; index < affected.size(); ++index)
+    {
+        const auto order = affected.get_order_at(index);
+        const auto position = affected.get_position_at(index);
+        ret.push_back(word_space->get_aligned_units(base->words[order], order, position));
+    }
+    return ret;
+}
+
+void ActionSpace::update_affected_with_after_id(MiniNode *node, const Affected &affected, const vec<pair<abc_t, abc_t>> &aligned_units, abc_t after_id) const
+{
+    const bool use_alignment = word_space->opt.use_alignment;
     auto new_affected = Affected(start_dist);
     for (size_t index = 0; index < affected.size(); ++index)
     {
         const auto order = affected.get_order_at(index);
         const auto position = affected.get_position_at(index);
-        float misalign_score = word_space->get_misalignment_score(node->base->words[order], order, position, after_id);
+        float misalign_score = use_alignment ? word_space->get_misalignment_score(aligned_units[index], after_id) : 0.0;
         new_affected.push_back(order, position, misalign_score);
     }
     ActionManager::add_action(node, after_id, new_affected);
@@ -34,7 +34,8 @@ class ActionSpace
     IdSeq change_id_seq(const IdSeq &, const vec<size_t> &, abc_t, SpecialType);
     void update_affected(BaseNode *, abc_t, int, size_t, map<abc_t, size_t> &, bool, abc_t) const;
     void update_affected_impl(BaseNode *, abc_t, int, size_t, map<abc_t, size_t> &, abc_t) const;
-    void update_affected_with_after_id(MiniNode *, const Affected &, abc_t) const;
+    void update_affected_with_after_id(MiniNode *, const Affected &, const vec<pair<abc_t, abc_t>> &, abc_t) const;
+    vec<pair<abc_t, abc_t>> get_aligned_units(const TreeNode *, const Affected &) const;
     // void update_affected(BaseNode *, const IdSeq &, int, size_t, int, map<abc_t, size_t> &);
 
     // Methods for expanding nodes.
@@ -16,42 +16,6 @@ bool Path::forms_a_circle(TreeNode *node) const
     return std::find(tree_nodes.begin(), tree_nodes.end(), node) != tree_nodes.end();
 }
 
-vec<Edge> Path::get_edges_to_root() const
-{
-    assert(subpaths.size() == tree_nodes.size() - 1);
-    auto edges = vec<Edge>();
-    edges.reserve(subpaths.size() * 7 + 1);
-    int i = tree_nodes.size() - 1;
-    for (auto it = subpaths.crbegin(); it != subpaths.crend(); ++it)
-    {
-        auto &subpath = *it;
-        auto edge = Edge();
-        edge.s0 = tree_nodes[i];
-        edge.a = subpath.chosen_seq[6];
-        edge.s1 = subpath.mini_node_seq[5];
-        edges.push_back(edge);
-
-        for (int j = 5; j >= 1; --j)
-        {
-            edge = Edge();
-            edge.s0 = subpath.mini_node_seq[j];
-            edge.a = subpath.chosen_seq[j];
-            edge.s1 = subpath.mini_node_seq[j - 1];
-            edges.push_back(edge);
-        }
-
-        edge = Edge();
-        edge.s0 = subpath.mini_node_seq[0];
-        edge.a = subpath.chosen_seq[0];
-        assert(i >= 1);
-        edge.s1 = tree_nodes[i - 1];
-        edges.push_back(edge);
-
-        --i;
-    }
-    return edges;
-}
-
 Mcts::Mcts(Env *env, const MctsOpt &opt) : env(env), opt(opt)
 {
     if (opt.num_threads > 1)
@@ -160,12 +124,9 @@ void Mcts::backup(const vec<Path> &paths, const vec<float> &values) const
     for (size_t i = 0; i < paths.size(); i++)
     {
         auto value = values[i];
-        auto edges = paths[i].get_edges_to_root();
-
         float rtg = 0.0;
-        for (auto it = edges.begin(); it != edges.end(); ++it)
-        {
-            auto &edge = *it;
+        // Walk the edges in place instead of collecting them first -- this is called for every simulation.
+        paths[i].for_each_edge_to_root([this, value, &rtg](const Edge &edge) {
             int index = edge.a.first;
             // abc_t best_char = edge.a.second;
             BaseNode *parent = edge.s1; // Since the edge points from child to parent, `s1` is used instead of `s0`.
@@ -173,7 +134,7 @@ void Mcts::backup(const vec<Path> &paths, const vec<float> &values) const
                 rtg += static_cast<TransitionNode *>(parent)->get_reward_at(index);
             float new_value = value + rtg;
             StatsManager::update_stats(parent, index, new_value, opt.game_count, opt.virtual_loss);
-        }
+        });
     }
 }
 
@@ -32,8 +32,9 @@ public:
     Path(const Path &);
     Path(TreeNode *, const int);
 
-    // Return all edges (s0, a, s1) from the descendant to the root.
-    vec<Edge> get_edges_to_root() const;
+    // Call `func` on all edges (s0, a, s1) from the descendant to the root, without storing them.
+    template <class F>
+    void for_each_edge_to_root(const F &func) const;
     int get_depth() const;
     // Append both subpath and tree node at the back.
     void append(const Subpath &, TreeNode *);
@@ -48,6 +49,23 @@ public:
     vec<abc_t> get_last_action_vec() const;
 };
 
+template <class F>
+void Path::for_each_edge_to_root(const F &func) const
+{
+    assert(subpaths.size() == tree_nodes.size() - 1);
+    int i = tree_nodes.size() - 1;
+    for (auto it = subpaths.crbegin(); it != subpaths.crend(); ++it)
+    {
+        const auto &subpath = *it;
+        func(Edge{tree_nodes[i], subpath.chosen_seq[6], subpath.mini_node_seq[5]});
+        for (int j = 5; j >= 1; --j)
+            func(Edge{subpath.mini_node_seq[j], subpath.chosen_seq[j], subpath.mini_node_seq[j - 1]});
+        assert(i >= 1);
+        func(Edge{subpath.mini_node_seq[0], subpath.chosen_seq[0], tree_nodes[i - 1]});
+        --i;
+    }
+}
+
 class Mcts
 {
     Pool *tp;
@@ -43,9 +43,21 @@ ChosenChar BaseNode::get_best_action(const SelectionOpt &sel_opt) const
     }
     else
     {
-        auto scores = get_scores(sel_opt);
-        auto it = std::max_element(scores.begin(), scores.end());
-        index = std::distance(scores.begin(), it);
+        assert(!stopped || !is_tree_node());
+        assert(priors.size() == pruned.size());
+        // Compute the scores and the argmax in one pass, without materializing the score vector.
+        float sqrt_ns = sqrt(static_cast<float>(visit_count));
+        index = 0;
+        float best_score = get_score_at(0, sel_opt, sqrt_ns);
+        for (size_t i = 1; i < priors.size(); ++i)
+        {
+            float score = get_score_at(i, sel_opt, sqrt_ns);
+            if (score > best_score)
+            {
+                best_score = score;
+                index = i;
+            }
+        }
     }
     auto ret = ChosenChar(index, permissible_chars[index]);
     SPDLOG_DEBUG("BaseNode: getting best subaction ({0}, {1})", ret.first, ret.second);
@@ -63,45 +75,36 @@ vec<float> BaseNode::get_scores(const SelectionOpt &sel_opt) const
     float sqrt_ns = sqrt(static_cast<float>(visit_count)); // + 1;
     auto scores = vec<float>(priors.size());
     assert(priors.size() == pruned.size());
-    // std::cerr << "=======================================\n";
     for (size_t i = 0; i < priors.size(); ++i)
-    {
-        float nsa = static_cast<float>(action_counts[i]);
-        float q;
-        if (sel_opt.use_max_value)
-            q = nsa > 0 ? max_values[i] : 0.0;
-        else
-            q = total_values[i] / (nsa + 1e-8);
-        float p = priors[i];
-        float u = sel_opt.puct_c * p * sqrt_ns / (1 + nsa);
-        // float h = heur_c * (static_cast<float>(affected[i].size())) / (1 + nsa);
-        // float h = heur_c * sqrt(static_cast<float>(affected[i].size())) / (1 + nsa);
-        float h;
-        if (sel_opt.use_num_misaligned)
-            h = sel_opt.heur_c > 0.0 ? sel_opt.heur_c * static_cast<float>(affected[i].get_num_misaligned()) / (1 + nsa) : 0.0;
-        else
-            h = sel_opt.heur_c > 0.0 ? sel_opt.heur_c * affected[i].get_misalignment_score() / (1 + nsa) : 0.0;
-        // std::cerr << permissible_chars[i] << ":" << h << " ";
-
-        // std::cerr << "--------------\n";
-        // std::cerr << affected[i].num_misaligned() << " ";
-        // for (size_t j = 0; j < affected[i].size(); ++j)
-        //     std::cerr << affected[i].positions[j] << " ";
-        // std::cerr << "\n";
-        // float h = (mv > -99.9) ? heur_c * mv / (1 + nsa) : 0.0;
-        // scores[i] = q + u + h;
-        // scores[i] = q + u + randf(0.001);
-        // scores[i] = pruned[i] ? -9999.9 : (q + u);
-        // scores[i] = pruned[i] ? -9999.9 : (q + u + h + randf(0.01));
-        float noise = sel_opt.add_noise ? randf(1e-8) : 0.0;
-        scores[i] = pruned[i] ? -9999.9 : (q + u + h + noise);
-        // scores[i] = pruned[i] ? -9999.9 : (mv + u + h + noise);
-        // scores[i] = q + u; //+ h + randf(0.01);
-    }
-    // std::cerr << "\n";
+        scores[i] = get_score_at(i, sel_opt, sqrt_ns);
     return scores;
 }
 
+float BaseNode::get_score_at(size_t i, const SelectionOpt &sel_opt, float sqrt_ns) const
+{
+    // Draw the noise before the pruned check so that `rand()` is called once per action, pruned or not.
+    float noise = sel_opt.add_noise ? randf(1e-8) : 0.0;
+    if (pruned[i])
+        return -9999.9;
+
+    float nsa = static_cast<float>(action_counts[i]);
+    float q;
+    if (sel_opt.use_max_value)
+        q = nsa > 0 ? max_values[i] : 0.0;
+    else
+        q = total_values[i] / (nsa + 1e-8);
+    float p = priors[i];
+    float u = sel_opt.puct_c * p * sqrt_ns / (1 + nsa);
+    float h;
+    if (sel_opt.heur_c <= 0.0)
+        h = 0.0;
+    else if (sel_opt.use_num_misaligned)
+        h = sel_opt.heur_c * static_cast<float>(affected[i].get_num_misaligned()) / (1 + nsa);
+    else
+        h = sel_opt.heur_c * affected[i].get_misalignment_score() / (1 + nsa);
+    return q + u + h + noise;
+}
+
 void BaseNode::prune()
 {
     SPDLOG_TRACE("Prune this node with #actions {}", num_unpruned_actions);
@@ -180,8 +183,9 @@ pair<BaseNode *, ChosenChar> BaseNode::play_mini(PlayStrategy ps, float exponent
     }
     else
     {
-        auto probs = vec<float>();
-        probs.reserve(action_counts.size());
+        // Build the unnormalized CDF directly and sample from it with a binary search.
+        auto cdf = vec<float>();
+        cdf.reserve(action_counts.size());
         float sum = 0.0;
         if (ps == PlayStrategy::SAMPLE_AC)
         {
@@ -189,10 +193,8 @@ pair<BaseNode *, ChosenChar> BaseNode::play_mini(PlayStrategy ps, float exponent
             {
                 auto ac = action_counts[i];
                 if (ac > 0)
-                    probs.push_back(pruned[i] ? 1e-8 : pow(static_cast<float>(ac), exponent));
-                else
-                    probs.push_back(0);
-                sum += probs.back();
+                    sum += pruned[i] ? 1e-8 : pow(static_cast<float>(ac), exponent);
+                cdf.push_back(sum);
             }
         }
         else if (ps == PlayStrategy::SAMPLE_MV)
@@ -202,32 +204,14 @@ pair<BaseNode *, ChosenChar> BaseNode::play_mini(PlayStrategy ps, float exponent
                 auto mv = max_values[i];
                 auto ac = action_counts[i];
                 if (ac > 0)
-                    if (pruned[i])
-                        probs.push_back(1e-8);
-                    else
-                        probs.push_back(exp(mv * exponent));
-                else
-                    probs.push_back(0);
-                sum += probs.back();
+                    sum += pruned[i] ? 1e-8 : exp(mv * exponent);
+                cdf.push_back(sum);
             }
         }
-        for (auto &prob : probs)
-            prob /= sum;
 
-        float r = randf(1.0);
-        float low = 0.0;
-        float high = 0.0;
-        index = 0;
-        for (size_t i = 0; i < probs.size(); ++i)
-        {
-            high += probs[i];
-            if ((r >= low) && (r < high))
-            {
-                index = i;
-                break;
-            }
-            low = high;
-        }
+        float r = randf(sum);
+        auto it = std::upper_bound(cdf.begin(), cdf.end(), r);
+        index = (it == cdf.end()) ? 0 : std::distance(cdf.begin(), it);
     }
     // // Select the node with the max average return, i.e., both puct_c and heur_c are set to 0.
     // auto scores = get_scores(0.0, 0.0);
@@ -497,7 +481,7 @@ inline void normalize(vec<float> &priors)
         prior /= sum;
 }
 
-inline vec<float> gather_priors(const vec<float> &values, const vec<abc_t> &indices)
+inline vec<float> gather_priors(const float *values, const vec<abc_t> &indices)
 {
     auto ret = vec<float>();
     ret.reserve(indices.size());
@@ -513,9 +497,16 @@ void TreeNode::evaluate(const vec<vec<float>> &meta_priors, const vec<float> &sp
     if (is_evaluated())
         return;
 
-    this->meta_priors = meta_priors;
+    meta_prior_size = meta_priors[0].size();
+    this->meta_priors.clear();
+    this->meta_priors.reserve(meta_priors.size() * meta_prior_size);
+    for (const auto &row : meta_priors)
+    {
+        assert(row.size() == meta_prior_size);
+        this->meta_priors.insert(this->meta_priors.end(), row.begin(), row.end());
+    }
     this->special_priors = special_priors;
-    priors = gather_priors(meta_priors[0], permissible_chars);
+    priors = gather_priors(this->meta_priors.data(), permissible_chars);
 }
 
 void BaseNode::clear_priors() { priors.clear(); }
@@ -567,7 +558,13 @@ const vec<float> &TransitionNode::get_rewards() const { return rewards; }
 
 void TreeNode::add_noise(const vec<vec<float>> &meta_noise, const vec<float> &special_noise, float noise_ratio)
 {
-    auto new_meta_priors = meta_priors;
+    auto new_meta_priors = vec<vec<float>>();
+    new_meta_priors.reserve(meta_noise.size());
+    for (size_t i = 0; i < meta_noise.size(); ++i)
+    {
+        auto row = meta_priors.begin() + i * meta_prior_size;
+        new_meta_priors.push_back(vec<float>(row, row + meta_prior_size));
+    }
     auto new_special_priors = special_priors;
     for (size_t i = 0; i < meta_noise.size(); ++i)
         for (size_t j = 0; j < meta_noise[i].size(); ++j)
@@ -598,15 +595,13 @@ vec<float> TreeNode::evaluate_actions(const vec<abc_t> &actions, ActionPhase ap)
         index = 5;
         break;
     }
-    const auto &full_priors = meta_priors.at(index);
-    // if (ap == ActionPhase::SPECIAL_TYPE)
-    //     std::cerr << full_priors.at(56) << " " << full_priors.at(4) << "\n";
-    return gather_priors(full_priors, actions);
+    assert((index + 1) * meta_prior_size <= meta_priors.size());
+    return gather_priors(meta_priors.data() + index * meta_prior_size, actions);
 }
 
 vec<float> TreeNode::evaluate_special_actions(const vec<abc_t> &actions) const
 {
-    return gather_priors(special_priors, actions);
+    return gather_priors(special_priors.data(), actions);
 }
 
 float TreeNode::get_dist() const { return dist; };
@@ -160,6 +160,8 @@ public:
     const Affected &get_affected_at(size_t) const;
     size_t get_num_affected_at(size_t) const;
     vec<float> get_scores(const SelectionOpt &) const;
+    // Get the selection score of one action, given the square root of the visit count.
+    float get_score_at(size_t, const SelectionOpt &, float) const;
     // Given the current action phase, get the best action.
     ChosenChar get_best_action(const SelectionOpt &) const;
     bool is_expanded() const;
@@ -286,7 +288,9 @@ public:
 private:
     friend class ActionManager;
 
-    vec<vec<float>> meta_priors;
+    // Meta priors of all phases are stored contiguously, `meta_prior_size` values per phase.
+    vec<float> meta_priors;
+    size_t meta_prior_size = 0;
     vec<float> special_priors;
     float dist = 0.0;
     bool done = false;
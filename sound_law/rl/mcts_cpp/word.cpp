@@ -213,18 +213,31 @@ float WordSpace::get_misalignment_score(const Word *word, int order, size_t posi
     if (!opt.use_alignment)
         return 0.0;
 
+    return get_misalignment_score(get_aligned_units(word, order, position), after_id);
+}
+
+pair<abc_t, abc_t> WordSpace::get_aligned_units(const Word *word, int order, size_t position) const
+{
     assert(opt.use_alignment);
     const auto &almt = word->get_almt_at(order);
     const auto c1 = word->id_seq[position];
     const auto aligned_pos = almt.aligned_pos[position];
     if (aligned_pos == alignment::INSERTED)
-        return ((after_id == 4) || (after_id == abc::NONE)) ? opt.ins_cost : 0.0;
+        return std::make_pair(c1, abc::NONE);
     assert(aligned_pos < end_words[order]->id_seq.size());
-    const auto c2 = end_words[order]->id_seq[aligned_pos];
+    return std::make_pair(c1, end_words[order]->id_seq[aligned_pos]);
+}
+
+float WordSpace::get_misalignment_score(const pair<abc_t, abc_t> &aligned_units, abc_t after_id) const
+{
+    const auto c1 = aligned_units.first;
+    const auto c2 = aligned_units.second;
+    if (c2 == abc::NONE)
+        return ((after_id == 4) || (after_id == abc::NONE)) ? opt.ins_cost : 0.0;
     if (after_id == 4)
         return opt.dist_mat[c1][c2] - opt.ins_cost;
     if (after_id == abc::NONE)
         return opt.dist_mat[c1][c2];
     else
         return opt.dist_mat[c1][c2] - opt.dist_mat[after_id][c2];
-}
\ No newline at end of file
+}
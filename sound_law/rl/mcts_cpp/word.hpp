@@ -68,4 +68,8 @@ public:
     size_t size() const;
     // Get misalignment score for `word` with the end state at `order` at `position`.
     float get_misalignment_score(const Word *, int, size_t, abc_t) const;
+    // Get the pair of aligned units (from `word` and the end state at `order`) at `position`. The second unit is `abc::NONE` for insertions.
+    pair<abc_t, abc_t> get_aligned_units(const Word *, int, size_t) const;
+    // Get misalignment score from a pair of aligned units, so that the alignment lookup can be shared across different `after_id`s.
+    float get_misalignment_score(const pair<abc_t, abc_t> &, abc_t) const;
 };
\ No newline at end of file
@@ -8,11 +8,12 @@ from typing import Dict, List, Optional, Sequence, Tuple
 import numpy as np
 import torch
 import torch.nn as nn
+from torch import Tensor
 
 from dev_misc import BT, FT, LT, NDA, add_argument, g, get_zeros
 from dev_misc.devlib.named_tensor import (NameHelper, NoName, duplicate,
                                           get_named_range)
-from dev_misc.utils import ScopedCache, handle_sequence_inputs
+from dev_misc.utils import handle_sequence_inputs
 from sound_law.data.alphabet import Alphabet
 from sound_law.data.dataset import EOT_ID
 from sound_law.evaluate.edit_dist import translate
@@ -21,7 +22,7 @@ from .beam_searcher import BaseBeamSearcher
 from .lstm_state import LstmStatesByLayers
 from .module import (CharEmbedding, EmbParams, GlobalAttention,
                      LanguageEmbedding, LstmParams, MultiLayerLSTMCell,
-                     NormControlledResidual, get_embedding)
+                     NormControlledResidual, concat_linear, get_embedding)
 
 try:
     import graphviz
@@ -51,6 +52,8 @@ class BeamConstant:
     src_paddings: BT
     max_lengths: LT
     lang_emb: Optional[FT] = None
+    output_embedding: Optional[FT] = None
+    Wh_s: Optional[FT] = None
 
 
 def _stack_beam(lst: List[torch.Tensor], last_name=None):
@@ -217,6 +220,10 @@ class LstmDecoder(nn.Module, BaseBeamSearcher):
     """A decoder that unrolls the LSTM decoding procedure by steps."""
 
     add_argument('input_feeding', default=False, dtype=bool, msg='Flag to use input feeding.')
+    add_argument('compile_decoder_step', default=False, dtype=bool,
+                 msg='Flag to compile the decoder step with `torch.compile` (reduce-overhead mode). The step still goes '
+                 'through named-tensor code in the embedding and attention modules, so it is compiled piecewise '
+                 'into several graphs rather than one. Requires torch>=2.1.')
 
     def __init__(self,
                  char_emb: CharEmbedding,
@@ -232,6 +239,7 @@ class LstmDecoder(nn.Module, BaseBeamSearcher):
         self.hidden = hidden
         self.nc_residual = nc_residual
         self.drop = nn.Dropout(dropout)
+        self._compiled_step = None
 
     @classmethod
     def from_params(cls,
@@ -263,39 +271,90 @@ class LstmDecoder(nn.Module, BaseBeamSearcher):
                 max_length: Optional[int] = None,
                 target: Optional[LT] = None,
                 lang_emb: Optional[FT] = None) -> Tuple[FT, FT]:
-        # Prepare inputs.
+        # Prepare inputs. Names are dropped once here so that the main loop only deals with unnamed tensors.
         max_length = self._get_max_length(max_length, target)
         batch_size = mask_src.size('batch')
-        input_ = self._prepare_first_input(sot_id, batch_size, mask_src.device)
+        input_ = self._prepare_first_input(sot_id, batch_size, mask_src.device).rename(None)
         prev_att = get_zeros(batch_size, g.hidden_size) if g.input_feeding else None
-        state = LstmStatesByLayers.zero_state(
-            self.cell.num_layers,
-            batch_size,
-            self.attn.input_tgt_size,
-            bidirectional=False)
-
-        # Main loop.
-        log_probs = list()
-        almt_distrs = list()
-        with ScopedCache('Wh_s'):
-            for l in range(max_length):
-                state, log_prob, almt_distr, prev_att = self._forward_step(
-                    input_, src_emb, state, src_outputs, mask_src,
-                    lang_emb=lang_emb, prev_att=prev_att)
-                if target is None:
-                    input_ = log_prob.max(dim=-1)[1].rename('batch')
-                else:
-                    input_ = target[l]
+        hs = [get_zeros(batch_size, self.attn.input_tgt_size) for _ in range(self.cell.num_layers)]
+        cs = [get_zeros(batch_size, self.attn.input_tgt_size) for _ in range(self.cell.num_layers)]
+        src_emb = src_emb.rename(None)
+        src_outputs = src_outputs.rename(None)
+        mask_src = mask_src.rename(None)
+        if target is not None:
+            target = target.rename(None)
+        if lang_emb is not None:
+            lang_emb = lang_emb.rename(None)
+        output_embedding = self._get_shared_output_embedding()
+        if output_embedding is not None:
+            output_embedding = output_embedding.rename(None)
+        # The projected source for attention is shared by all steps.
+        Wh_s = self.attn.get_Wh_s(src_outputs)
+
+        # Main loop. Without grad, outputs of every step are written into buffers that are allocated once. With grad,
+        # they are stacked at the end instead -- writing into slices of a buffer would make backward copy the whole
+        # buffer's gradient once per step.
+        step_fn = self._get_step_fn()
+        use_buffer = not torch.is_grad_enabled()
+        log_probs, almt_distrs = (None, None) if use_buffer else (list(), list())
+        for l in range(max_length):
+            hs, cs, log_prob, almt_distr, prev_att = step_fn(
+                input_, src_emb, hs, cs, src_outputs, mask_src,
+                lang_emb=lang_emb, prev_att=prev_att, output_embedding=output_embedding, Wh_s=Wh_s)
+            if target is None:
+                input_ = log_prob.max(dim=-1)[1]
+            else:
+                input_ = target[l]
 
+            if not use_buffer:
                 log_probs.append(log_prob)
                 almt_distrs.append(almt_distr)
+            else:
+                if log_probs is None:
+                    log_probs = log_prob.new_empty((max_length, ) + log_prob.shape)
+                    almt_distrs = almt_distr.new_empty((max_length, ) + almt_distr.shape)
+                log_probs[l] = log_prob
+                almt_distrs[l] = almt_distr
 
         # Prepare outputs.
-        with NoName(*log_probs), NoName(*almt_distrs):
-            log_probs = torch.stack(log_probs).rename('pos', 'batch', 'unit')
-            almt_distrs = torch.stack(almt_distrs).rename('tgt_pos', 'batch', 'src_pos')
+        if not use_buffer:
+            log_probs = torch.stack(log_probs, dim=0)
+            almt_distrs = torch.stack(almt_distrs, dim=0)
+        log_probs = log_probs.rename('pos', 'batch', 'unit')
+        almt_distrs = almt_distrs.rename('tgt_pos', 'batch', 'src_pos')
         return log_probs, almt_distrs
 
+    def _get_shared_output_embedding(self) -> Optional[FT]:
+        """Return the output embedding to be shared by all decoding steps, or None if it has to be recomputed every step.
+
+        Computing the output embedding is not free for `PhonoEmbedding`, but it applies dropout to the feature embeddings.
+        It is therefore only shared when that dropout is inactive, so that training still draws a fresh mask every step.
+        """
+        if self.char_emb.training and self.char_emb.drop.p > 0.0:
+            return None
+        return self.char_emb.output_embedding
+
+    def _get_step_fn(self):
+        """Return the function used for every decoding step, which is compiled if `g.compile_decoder_step` is set."""
+        if not g.compile_decoder_step:
+            return self._forward_step_unnamed
+        if not hasattr(torch, 'compiler') or not hasattr(torch.compiler, 'cudagraph_mark_step_begin'):
+            raise RuntimeError(f'`torch.compile` with CUDA graphs is not supported in torch {torch.__version__}.')
+        if self._compiled_step is None:
+            # Every step has the same shapes within a batch, so CUDA graphs captured in reduce-overhead mode can be replayed.
+            compiled = torch.compile(self._forward_step_unnamed, mode='reduce-overhead')
+
+            def step(*args, **kwargs):
+                # Each call is a new step, and every replay reuses the memory of the outputs of the previous one. Outputs
+                # are therefore cloned, since they are fed back as inputs or kept until the end of decoding.
+                torch.compiler.cudagraph_mark_step_begin()
+                hs, cs, log_prob, almt, hid_res = compiled(*args, **kwargs)
+                return ([h.clone() for h in hs], [c.clone() for c in cs],
+                        log_prob.clone(), almt.clone(), hid_res.clone())
+
+            self._compiled_step = step
+        return self._compiled_step
+
     def _get_max_length(self, max_length: Optional[int], target: Optional[LT]) -> int:
         if self.training:
             assert target is not None
@@ -316,26 +375,61 @@ class LstmDecoder(nn.Module, BaseBeamSearcher):
                       src_states: FT,
                       mask_src: BT,
                       lang_emb: Optional[FT] = None,
-                      prev_att: Optional[FT] = None) -> Tuple[FT, FT, FT, FT]:
+                      prev_att: Optional[FT] = None,
+                      output_embedding: Optional[FT] = None,
+                      Wh_s: Optional[FT] = None) -> Tuple[FT, FT, FT, FT]:
+        """Named wrapper around `_forward_step_unnamed`."""
+        state_names = state.names
+        hs, cs = zip(*[state.get_layer(i) for i in range(state.num_layers)])
+        hs = [h.rename(None) for h in hs]
+        cs = [c.rename(None) for c in cs]
+        if lang_emb is not None:
+            lang_emb = lang_emb.rename(None)
+        if prev_att is not None:
+            prev_att = prev_att.rename(None)
+        if output_embedding is not None:
+            output_embedding = output_embedding.rename(None)
+        if Wh_s is not None:
+            Wh_s = Wh_s.rename(None)
+        hs, cs, log_prob, almt, hid_res = self._forward_step_unnamed(
+            input_.rename(None), src_emb.rename(None), hs, cs,
+            src_states.rename(None), mask_src.rename(None),
+            lang_emb=lang_emb, prev_att=prev_att, output_embedding=output_embedding, Wh_s=Wh_s)
+
+        next_state = LstmStatesByLayers([(h.rename(*state_names), c.rename(*state_names)) for h, c in zip(hs, cs)])
+        log_prob = log_prob.rename('batch', 'unit')
+        almt = almt.rename(*reversed(mask_src.names))
+        hid_res = hid_res.rename('batch', 'hidden')
+        return next_state, log_prob, almt, hid_res
+
+    def _forward_step_unnamed(self,
+                              input_: Tensor,
+                              src_emb: Tensor,
+                              hs: List[Tensor],
+                              cs: List[Tensor],
+                              src_states: Tensor,
+                              mask_src: Tensor,
+                              lang_emb: Optional[Tensor] = None,
+                              prev_att: Optional[Tensor] = None,
+                              output_embedding: Optional[Tensor] = None,
+                              Wh_s: Optional[Tensor] = None) -> Tuple[List[Tensor], List[Tensor], Tensor, Tensor, Tensor]:
+        """One decoding step on unnamed tensors. Returns the new per-layer states, the log probabilities (bs x V),
+        the alignment (bs x sl) and the attentional hidden state (bs x d)."""
         emb = self.char_emb(input_)
         if lang_emb is not None:
             emb = emb + lang_emb
         inp = torch.cat([emb, prev_att], dim=-1) if g.input_feeding else emb
-        hid_rnn, next_state = self.cell(inp, state)  # hid_rnn has gone through dropout already.
-        almt, ctx = self.attn.forward(hid_rnn, src_states, mask_src)  # So has src_states.
-        with NoName(hid_rnn, ctx):
-            cat = torch.cat([hid_rnn, ctx], dim=-1)
-        hid_cat = self.hidden(cat)
+        hid_rnn, hs, cs = self.cell.forward_unnamed(inp, hs, cs)  # hid_rnn has gone through dropout already.
+        almt, ctx = self.attn.forward_unnamed(hid_rnn, src_states, mask_src, Wh_s=Wh_s)  # So has src_states.
+        hid_cat = concat_linear(hid_rnn, ctx, self.hidden.weight, self.hidden.bias)
         hid_cat = self.drop(hid_cat)
 
-        with NoName(src_emb, hid_cat, almt):
-            ctx_emb = (src_emb * almt.t().unsqueeze(dim=-1)).sum(dim=0)
-            hid_res = self.nc_residual(ctx_emb, hid_cat).rename('batch', 'hidden')
+        ctx_emb = (src_emb * almt.t().unsqueeze(dim=-1)).sum(dim=0)
+        hid_res = self.nc_residual(ctx_emb, hid_cat)
 
-        logit = self.char_emb.project(hid_res)
-        log_prob = logit.log_softmax(dim=-1).refine_names('batch', 'unit')
+        log_prob = self.char_emb.project_log_softmax(hid_res, output_embedding=output_embedding)
 
-        return next_state, log_prob, almt, hid_res
+        return hs, cs, log_prob, almt, hid_res
 
     def is_finished(self, beam: Beam) -> BT:
         return beam.finished
@@ -360,7 +454,9 @@ class LstmDecoder(nn.Module, BaseBeamSearcher):
             beam.constants.src_outputs,
             beam.constants.src_paddings,
             lang_emb=beam.constants.lang_emb,
-            prev_att=prev_att)
+            prev_att=prev_att,
+            output_embedding=beam.constants.output_embedding,
+            Wh_s=beam.constants.Wh_s)
 
         def unflatten(orig, is_lstm_state: bool = False):
             def wrapped(tensor):
@@ -380,9 +476,8 @@ class LstmDecoder(nn.Module, BaseBeamSearcher):
         nh = NameHelper()
 
         # Get the new scores. For finished hypotheses, we should keep adding EOT.
-        placeholder = torch.full_like(cand.log_probs, -9999.9)
-        placeholder[..., EOT_ID] = 0.0
-        new_scores = torch.where(beam.finished.align_as(placeholder), placeholder, cand.log_probs)
+        new_scores = cand.log_probs.masked_fill(beam.finished.align_as(cand.log_probs), -9999.9)
+        new_scores[..., EOT_ID].masked_fill_(beam.finished, 0.0)
         accum = new_scores + beam.accum_scores.align_as(cand.log_probs)
         lp = nh.flatten(accum, ['beam', 'unit'], 'BU')
         top_s, top_i = torch.topk(lp, beam.beam_size, dim='BU')
@@ -460,7 +555,9 @@ class LstmDecoder(nn.Module, BaseBeamSearcher):
         max_lengths = expand_beam(max_lengths, collapse=False)
         constants = BeamConstant(src_emb, src_outputs, src_paddings,
                                  max_lengths,
-                                 lang_emb=lang_emb)
+                                 lang_emb=lang_emb,
+                                 output_embedding=self._get_shared_output_embedding(),
+                                 Wh_s=self.attn.get_Wh_s(src_outputs))
         init_beam = Beam(0, accum_scores, tokens,
                          lstm_state, constants, prev_att=init_att)
         hyps = super().search(init_beam)
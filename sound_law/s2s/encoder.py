@@ -39,9 +39,10 @@ class LstmEncoder(nn.Module):
     def forward(self, input_: LT, lengths: LT) -> Tuple[FT, LstmOutputTuple]:
         emb = self.embedding(input_)
         with NoName(emb, lengths):
-            packed_emb = pack_padded_sequence(emb, lengths, enforce_sorted=False)
+            # `pack_padded_sequence` expects lengths on cpu.
+            packed_emb = pack_padded_sequence(emb, lengths.cpu(), enforce_sorted=False)
             output, state = self.lstm(packed_emb)
-            output = pad_packed_sequence(output)[0]
+            output = pad_packed_sequence(output, total_length=emb.size(0))[0]
             output = self.drop(output)  # Dropout after last output, different from the behavior for nn.LSTM.
         return emb, (output, LstmStateTuple(state, bidirectional=self.lstm.bidirectional))
 
@@ -11,12 +11,13 @@ import gzip
 import numpy
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.nn.init
+from torch import Tensor
 from torch.nn.functional import normalize
 
 from dev_misc import BT, FT, LT, add_argument, g, get_zeros
 from dev_misc.devlib.named_tensor import NameHelper, NoName
-from dev_misc.utils import cacheable
 from sound_law.data.alphabet import PAD_ID
 from sound_law.s2s.lstm_state import LstmStatesByLayers, LstmStateTuple
 
@@ -32,6 +33,48 @@ class LstmParams:
     bidirectional: bool
 
 
+@torch.jit.script
+def fused_dropout_cell(input_: Tensor, h: Tensor, c: Tensor,
+                       w_ih: Tensor, w_hh: Tensor, b_ih: Tensor, b_hh: Tensor,
+                       dropout: float, training: bool) -> Tuple[Tensor, Tensor, Tensor]:
+    """Same computation as `nn.LSTMCell` followed by dropout on the new hidden state, written out so that
+    the gate nonlinearities and the dropout mask can be fused. Return the dropped-out output and the new state.
+    """
+    gates = F.linear(input_, w_ih, b_ih) + F.linear(h, w_hh, b_hh)
+    i, f, g, o = gates.chunk(4, dim=1)
+    new_c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+    new_h = torch.sigmoid(o) * torch.tanh(new_c)
+    if training and dropout > 0.0:
+        output = F.dropout(new_h, dropout, True)
+    else:
+        output = new_h
+    return output, new_h, new_c
+
+
+@torch.jit.script
+def multi_layer_lstm_cell(input_: Tensor,
+                          hs: List[Tensor],
+                          cs: List[Tensor],
+                          weights_ih: List[Tensor],
+                          weights_hh: List[Tensor],
+                          biases_ih: List[Tensor],
+                          biases_hh: List[Tensor],
+                          dropout: float,
+                          training: bool) -> Tuple[Tensor, List[Tensor], List[Tensor]]:
+    """Run one step through all layers. All tensors should be unnamed."""
+    new_hs = torch.jit.annotate(List[Tensor], [])
+    new_cs = torch.jit.annotate(List[Tensor], [])
+    for i in range(len(hs)):
+        # Note that the last layer also uses dropout, which is different from nn.LSTM.
+        input_, new_h, new_c = fused_dropout_cell(input_, hs[i], cs[i],
+                                                  weights_ih[i], weights_hh[i],
+                                                  biases_ih[i], biases_hh[i],
+                                                  dropout, training)
+        new_hs.append(new_h)
+        new_cs.append(new_c)
+    return input_, new_hs, new_cs
+
+
 class MultiLayerLSTMCell(nn.Module):
     """An LSTM cell with multiple layers."""
 
@@ -62,18 +105,23 @@ class MultiLayerLSTMCell(nn.Module):
     def forward(self, input_: FT, state: LstmStatesByLayers, state_direction: Optional[str] = None) -> LstmOutputsByLayers:
         assert state.num_layers == self.num_layers
 
-        new_states = list()
-        for i in range(self.num_layers):
-            h, c = state.get_layer(i, state_direction)
-            with NoName(input_, h, c):
-                new_h, new_c = self.cells[i](input_, (h, c))
-            new_h.rename_(*h.names)
-            new_c.rename_(*c.names)
-            new_states.append((new_h, new_c))
-            input_ = new_h.refine_names('batch', ...)
-            # Note that the last layer also uses dropout, which is different from nn.LSTM.
-            input_ = self.drop(input_)
-        return input_, LstmStatesByLayers(new_states)
+        hs, cs = zip(*[state.get_layer(i, state_direction) for i in range(self.num_layers)])
+        names = hs[0].names
+        with NoName(input_, *hs, *cs):
+            output, new_hs, new_cs = self.forward_unnamed(input_, list(hs), list(cs))
+        new_states = [(h.rename(*names), c.rename(*names)) for h, c in zip(new_hs, new_cs)]
+        output = output.rename(*names).refine_names('batch', ...)
+        return output, LstmStatesByLayers(new_states)
+
+    def forward_unnamed(self, input_: Tensor, hs: List[Tensor], cs: List[Tensor]) -> Tuple[Tensor, List[Tensor], List[Tensor]]:
+        """Same as `forward` but works on unnamed tensors, with states given as lists of per-layer `h` and `c`."""
+        # NOTE(j_luo) Parameters are gathered from the original `nn.LSTMCell` modules so that old checkpoints can still be loaded.
+        return multi_layer_lstm_cell(input_, hs, cs,
+                                     [cell.weight_ih for cell in self.cells],
+                                     [cell.weight_hh for cell in self.cells],
+                                     [cell.bias_ih for cell in self.cells],
+                                     [cell.bias_hh for cell in self.cells],
+                                     self.drop.p, self.training)
 
     def extra_repr(self):
         return '%d, %d, num_layers=%d' % (self.input_size, self.hidden_size, self.num_layers)
@@ -89,6 +137,12 @@ class EmbParams:
     separate_output: bool = False  # Whether to use a separate set of params for output embeddings.
 
 
+@torch.jit.script
+def linear_log_softmax(h: Tensor, weight: Tensor) -> Tensor:
+    """Project `h` with `weight` (without bias) and normalize over the last dimension. All tensors should be unnamed."""
+    return F.linear(h, weight).log_softmax(dim=-1)
+
+
 class CharEmbedding(nn.Embedding):
 
     def __init__(self, *args,
@@ -111,6 +165,15 @@ class CharEmbedding(nn.Embedding):
         w = self.drop(self.output_embedding)
         return h @ w.t()
 
+    def project_log_softmax(self, h: FT, output_embedding: Optional[FT] = None) -> FT:
+        """Same as calling `log_softmax` on the outputs of `project`, but done in one scripted call.
+        `output_embedding` can be passed in if it has already been computed, e.g., once for all decoding steps."""
+        if output_embedding is None:
+            output_embedding = self.output_embedding
+        w = self.drop(output_embedding)
+        with NoName(h, w):
+            return linear_log_softmax(h, w)
+
     def forward(self, *args, **kwargs) -> FT:
         emb = super().forward(*args, **kwargs)
         return self.drop(emb)
@@ -168,8 +231,9 @@ class PhonoEmbedding(CharEmbedding):
         return torch.where(self.special_mask.view(-1, 1), self.special_weight, emb)
 
     def forward(self, input_: LT) -> FT:
-        with NoName(self.char_embedding, input_):
-            return self.char_embedding[input_]
+        char_embedding = self.char_embedding
+        with NoName(char_embedding, input_):
+            return F.embedding(input_, char_embedding)
 
     @property
     def output_embedding(self):
@@ -184,6 +248,16 @@ def get_embedding(emb_params: EmbParams) -> Union[PhonoEmbedding, CharEmbedding]
     return embedding
 
 
+@torch.jit.script
+def attend(Wh_s: Tensor, h_s: Tensor, h_t: Tensor, mask: Tensor) -> Tuple[Tensor, Tensor]:
+    """Compute the alignment (bs x sl) and the context vector (bs x ds) with batched matmuls in one scripted call.
+    `Wh_s` and `h_s` are sl x bs x d, `h_t` is bs x d and `mask` is sl x bs. All tensors should be unnamed."""
+    scores = torch.bmm(Wh_s.transpose(0, 1), h_t.unsqueeze(-1)).squeeze(-1)  # bs x sl
+    almt_distr = scores.masked_fill_(~mask.t(), -9999.9).softmax(dim=-1)
+    ctx = torch.bmm(almt_distr.unsqueeze(1), h_s.transpose(0, 1)).squeeze(1)  # bs x ds
+    return almt_distr, ctx
+
+
 class GlobalAttention(nn.Module):
 
     def __init__(self,
@@ -197,34 +271,44 @@ class GlobalAttention(nn.Module):
         self.Wa = nn.Parameter(torch.Tensor(input_src_size, input_tgt_size))
         torch.nn.init.xavier_normal_(self.Wa)
 
-    @cacheable(switch='Wh_s')
-    def _get_Wh_s(self, h_s: FT) -> FT:
-        sl, bs, ds = h_s.size()
+    def get_Wh_s(self, h_s: FT) -> FT:
+        """Project the source states (sl x bs x ds) with `Wa`. This only depends on the source, so callers that
+        attend to the same source repeatedly should compute it once and pass it to `forward`. The result is unnamed."""
         with NoName(h_s):
-            Wh_s = h_s.reshape(sl * bs, -1).mm(self.Wa).view(sl, bs, -1)
-        return Wh_s
+            return h_s.matmul(self.Wa)
 
     def forward(self,
                 h_t: FT,
                 h_s: FT,
-                mask_src: BT) -> Tuple[FT, FT]:
-        dt = h_t.shape[-1]
-        Wh_s = self._get_Wh_s(h_s)
-
-        with NoName(h_t):
-            scores = (Wh_s * h_t).sum(dim=-1)
-
-        scores = torch.where(mask_src, scores, torch.full_like(scores, -9999.9))
-        almt_distr = nn.functional.log_softmax(scores, dim=0).exp()  # sl x bs
-        with NoName(almt_distr):
-            ctx = (almt_distr.unsqueeze(dim=-1) * h_s).sum(dim=0)  # bs x d
-        almt_distr = almt_distr.t()
+                mask_src: BT,
+                Wh_s: Optional[FT] = None) -> Tuple[FT, FT]:
+        names = mask_src.names
+        ctx_names = h_s.names[1:]
+        with NoName(h_t, h_s, mask_src):
+            almt_distr, ctx = self.forward_unnamed(h_t, h_s, mask_src, Wh_s=Wh_s)
+        almt_distr = almt_distr.rename(*reversed(names))
+        ctx = ctx.rename(*ctx_names)
         return almt_distr, ctx
 
+    def forward_unnamed(self, h_t: Tensor, h_s: Tensor, mask_src: Tensor,
+                        Wh_s: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+        """Same as `forward` but works on unnamed tensors. Returns the alignment (bs x sl) and the context (bs x d)."""
+        if Wh_s is None:
+            Wh_s = self.get_Wh_s(h_s)
+        return attend(Wh_s, h_s, h_t, mask_src)
+
     def extra_repr(self):
         return 'src=%d, tgt=%d' % (self.input_src_size, self.input_tgt_size)
 
 
+@torch.jit.script
+def concat_linear(x1: Tensor, x2: Tensor, weight: Tensor, bias: Tensor) -> Tensor:
+    """Same as `F.linear(torch.cat([x1, x2], dim=-1), weight, bias)` but without materializing the concatenation.
+    All tensors should be unnamed."""
+    d1 = x1.size(-1)
+    return F.linear(x1, weight[:, :d1], bias).addmm_(x2, weight[:, d1:].t())
+
+
 class NormControlledResidual(nn.Module):
 
     def __init__(self, norms_or_ratios=None, multiplier=1.0, control_mode=None):